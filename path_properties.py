@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 
+import functools
+import itertools
 import os
 import signal
+import types
 
 from shell_helpers import LF
 
+# Signals expected by path_properties_tuples.
+SIGABRT = signal.Signals.SIGABRT
+SIGFPE = signal.Signals.SIGFPE
+SIGHUP = signal.Signals.SIGHUP
+SIGILL = signal.Signals.SIGILL
+SIGSEGV = signal.Signals.SIGSEGV
+
 class PathProperties:
     default_c_std = 'c11'
     default_cxx_std = 'c++17'
     # All new properties must be listed here or else you get an error.
-    default_properties = {
+    # Read-only, since it is shared by the tree root and the paths that don't override anything.
+    default_properties = types.MappingProxyType({
         'allowed_archs': None,
         'allowed_emulators': None,
         # The example uses aarch32 instructions which are not present in ARMv7.
@@ -106,7 +117,9 @@ class PathProperties:
         # Known instructions that this test uses, and which may not be implemented
         # in a given simulator, in which case we skip.
         'uses_instructions': {},
-    }
+    })
+
+    _default_keys = frozenset(default_properties)
 
     unimplemented_instructions = {
         'gem5': {
@@ -157,6 +170,54 @@ class PathProperties:
     # TODO maybe extract automatically from GCC executable?
     current_gcc_version = (7, 3, 0)
 
+    # Properties that prevent a path from being tested when they are set,
+    # either always, or only for a given mode or emulator.
+    skip_test_properties = (
+        'disrupts_system',
+        'interactive',
+        'more_than_1s',
+        'no_executable',
+        'requires_argument',
+        'requires_internet',
+        'requires_kernel_modules',
+        'requires_sudo',
+        'skip_run_unclassified',
+        'qemu_x86_64_int_syscall',
+    )
+    skip_test_properties_mode = {
+        'baremetal': (
+            'arm_aarch32',
+            'signal_generated_by_os',
+        ),
+    }
+    skip_test_properties_emulator = {
+        'gem5': (
+            'gem5_unimplemented_syscall',
+            # https://github.com/cirosantilli/linux-kernel-module-cheat/issues/101
+            'signal_received',
+            'requires_dynamic_library',
+            'requires_semihosting',
+            'requires_syscall_getcpu',
+        ),
+        'qemu': (
+            'requires_m5ops',
+        ),
+    }
+    # One bit of skip_mask for each of the above properties, so that should_be_tested
+    # can check all of them with a single AND.
+    _skip_test_bits = {
+        key: 1 << i for i, key in enumerate(itertools.chain(
+            skip_test_properties,
+            *skip_test_properties_mode.values(),
+            *skip_test_properties_emulator.values()
+        ))
+    }
+    # signal_received is a signal or None, all the others are booleans.
+    _skip_test_bool_bits = {
+        key: bit for key, bit in _skip_test_bits.items() if key != 'signal_received'
+    }
+    _skip_test_env_masks = {}
+
     '''
     Encodes properties of userland and baremetal paths.
     For directories, it applies to all files under the directory.
@@ -166,128 +227,165 @@ class PathProperties:
         self,
         properties
     ):
-        for key in properties:
-            if not key in self.default_properties:
-                raise ValueError('Unknown key: {}'.format(key))
-        self.properties = properties.copy()
+        self._check_keys(properties)
+        self._set_properties(properties)
+
+    @classmethod
+    def _check_keys(cls, properties):
+        unknown_keys = properties.keys() - cls._default_keys
+        if unknown_keys:
+            raise ValueError('Unknown keys: {}'.format(', '.join(sorted(unknown_keys))))
+
+    @classmethod
+    def _unchecked(cls, properties, skip_mask=None):
+        '''
+        Like the constructor, but for properties that are already known to be valid,
+        e.g. because they come from another PathProperties, so keys are not checked.
+        '''
+        path_properties = cls.__new__(cls)
+        path_properties._set_properties(properties, skip_mask)
+        return path_properties
+
+    def _set_properties(self, properties, skip_mask=None):
+        # Not copied until update modifies it, since most instances never are.
+        # Modify properties only through update.
+        self.properties = properties
+        self._properties_shared = True
+        if skip_mask is None:
+            self._update_skip_mask()
+        else:
+            self.skip_mask = skip_mask
 
     def __getitem__(self, key):
         return self.properties[key]
 
     def __repr__(self):
-        return str(self.properties)
+        return str(dict(self.properties))
+
+    def _update_skip_mask(self):
+        skip_mask = 0
+        properties = self.properties
+        for key, bit in self._skip_test_bool_bits.items():
+            if properties.get(key):
+                skip_mask |= bit
+        if properties.get('signal_received') is not None:
+            skip_mask |= self._skip_test_bits['signal_received']
+        self.skip_mask = skip_mask
+
+    @classmethod
+    def _get_skip_test_env_mask(cls, mode, emulator):
+        '''
+        Mask of the skip_mask bits that prevent testing in the given mode and emulator.
+        '''
+        key = (mode, emulator)
+        env_mask = cls._skip_test_env_masks.get(key)
+        if env_mask is None:
+            env_mask = 0
+            for property_key in (
+                cls.skip_test_properties +
+                cls.skip_test_properties_mode.get(mode, ()) +
+                cls.skip_test_properties_emulator.get(emulator, ())
+            ):
+                env_mask |= cls._skip_test_bits[property_key]
+            cls._skip_test_env_masks[key] = env_mask
+        return env_mask
 
     def set_path_components(self, path_components):
         self.path_components = path_components
+        # Derived values needed by the should_be_* predicates, computed only once per path.
+        if path_components:
+            self.ext = os.path.splitext(path_components[-1])[1]
+        else:
+            self.ext = ''
+        # Package name of paths under userland/libs, None for all other paths.
+        if len(path_components) > 2 and path_components[1] == 'libs':
+            self.libs_package = path_components[2]
+        else:
+            self.libs_package = None
 
     def should_be_built(
         self,
         env,
         link=False,
     ):
-        ext = os.path.splitext(self.path_components[-1])[1]
-        return (
-            not (
-                len(self.path_components) > 1 and \
-                self.path_components[1] == 'libs' and \
-                not env['package_all'] and \
-                not self.path_components[2] in env['package']
-            ) and
-            not self['no_build'] and
-            (
-                self['allowed_archs'] is None or
-                env['arch'] in self['allowed_archs']
-            ) and
-            not (
-                (
-                    env['mode'] == 'userland' and
-                    (
-                        not self['userland'] or
-                        not ext in env['build_in_exts']
-                    )
-                ) or
-                (
-                    env['mode'] == 'baremetal' and (
-                        not self['baremetal'] or
-                        not ext in env['baremetal_build_in_exts']
-                    )
-                )
-            ) and
-            not (
-                link and
-                self['no_executable']
-            ) and not (
-                # Our C compiler does not suppport SVE yet.
-                # https://cirosantilli.com/linux-kernel-module-cheat#update-gcc-gcc-supported-by-buildroot
-                os.path.splitext(self.path_components[-1])[1] == '.c' and self['arm_sve']
-            ) and not (
-                # C++ multithreading in static does not seem to work:
-                # https://cirosantilli.com/linux-kernel-module-cheat#cpp-static-and-pthreads
-                os.path.splitext(self.path_components[-1])[1] == '.cpp' and (
-                    # TODO the better check here would be for 'static'
-                    # to factor out with test-executable logic, but lazy.
-                    # env['static'] and
-                    env['emulator'] == 'gem5' and
-                    'cpus' in self['test_run_args'] and
-                    self['test_run_args']['cpus'] > 1
-                )
-            ) and not (
-                self['minimum_gcc_version'] > self.current_gcc_version
-            )
-        )
+        properties = self.properties
+        arch = env['arch']
+        emulator = env['emulator']
+        mode = env['mode']
+        # Checks are ordered roughly from the most to the least likely to exclude a path,
+        # and return as soon as the answer is known.
+        if properties['no_build']:
+            return False
+        if not (
+            properties['allowed_archs'] is None or
+            arch in properties['allowed_archs']
+        ):
+            return False
+        ext = self.ext
+        if mode == 'userland':
+            if (
+                not properties['userland'] or
+                not ext in env['build_in_exts']
+            ):
+                return False
+        elif mode == 'baremetal':
+            if (
+                not properties['baremetal'] or
+                not ext in env['baremetal_build_in_exts']
+            ):
+                return False
+        libs_package = self.libs_package
+        if (
+            libs_package is not None and
+            not env['package_all'] and
+            not libs_package in env['package']
+        ):
+            return False
+        if link and properties['no_executable']:
+            return False
+        # Our C compiler does not suppport SVE yet.
+        # https://cirosantilli.com/linux-kernel-module-cheat#update-gcc-gcc-supported-by-buildroot
+        if ext == '.c' and properties['arm_sve']:
+            return False
+        # C++ multithreading in static does not seem to work:
+        # https://cirosantilli.com/linux-kernel-module-cheat#cpp-static-and-pthreads
+        if (
+            ext == '.cpp' and
+            # TODO the better check here would be for 'static'
+            # to factor out with test-executable logic, but lazy.
+            # env['static'] and
+            emulator == 'gem5' and
+            'cpus' in properties['test_run_args'] and
+            properties['test_run_args']['cpus'] > 1
+        ):
+            return False
+        return not properties['minimum_gcc_version'] > self.current_gcc_version
 
     def should_be_tested(self, env):
-        basename = self.path_components[-1]
-        return (
-            self.should_be_built(
-                env,
-            ) and
-            not basename.startswith(env['tmp_prefix']) and
-            not (
-                env['mode'] == 'baremetal' and (
-                    self['arm_aarch32'] or
-                    self['signal_generated_by_os']
-                )
-            ) and
-            not self['disrupts_system'] and
-            not self['interactive'] and
-            not self['more_than_1s'] and
-            not self['no_executable'] and
-            not self['requires_argument'] and
-            not self['requires_internet'] and
-            not self['requires_kernel_modules'] and
-            not self['requires_sudo'] and
-            not self['skip_run_unclassified'] and
-            not self['qemu_x86_64_int_syscall'] and
-            not (
-                env['emulator'] == 'gem5' and
-                (
-                    self['gem5_unimplemented_syscall'] or
-                    # https://github.com/cirosantilli/linux-kernel-module-cheat/issues/101
-                    self['signal_received'] is not None or
-                    self['requires_dynamic_library'] or
-                    self['requires_semihosting'] or
-                    self['requires_syscall_getcpu']
-                )
-            ) and
-            not (
-                env['emulator'] == 'qemu' and
-                (
-                    self['requires_m5ops']
-                )
-            ) and
-            not (
-                env['arch'] in self['uses_instructions'] and
-                env['emulator'] in self.unimplemented_instructions and
-                env['arch'] in self.unimplemented_instructions[env['emulator']] and
-                (
-                    self.unimplemented_instructions[env['emulator']][env['arch']] &
-                    self['uses_instructions'][env['arch']]
-                )
-            ) and
+        properties = self.properties
+        arch = env['arch']
+        emulator = env['emulator']
+        mode = env['mode']
+        if not self.should_be_built(
+            env,
+        ):
+            return False
+        if self.path_components[-1].startswith(env['tmp_prefix']):
+            return False
+        if self.skip_mask & self._get_skip_test_env_mask(mode, emulator):
+            return False
+        if not (
+            properties['allowed_emulators'] is None or
+            emulator in properties['allowed_emulators']
+        ):
+            return False
+        return not (
+            arch in properties['uses_instructions'] and
+            emulator in self.unimplemented_instructions and
+            arch in self.unimplemented_instructions[emulator] and
             (
-                self['allowed_emulators'] is None or
-                env['emulator'] in self['allowed_emulators']
+                self.unimplemented_instructions[emulator][arch] &
+                properties['uses_instructions'][arch]
             )
         )
 
@@ -300,61 +398,124 @@ class PathProperties:
 
     def _update_list(self, other_tmp_properties, key):
         if key in self.properties and key in other_tmp_properties:
-            other_tmp_properties[key] = \
-                self.properties[key] + \
-                other_tmp_properties[key]
+            # Share the existing list rather than copying it when there is nothing to append,
+            # merged lists are never modified in place.
+            if not other_tmp_properties[key]:
+                other_tmp_properties[key] = self.properties[key]
+            elif self.properties[key]:
+                other_tmp_properties[key] = \
+                    self.properties[key] + \
+                    other_tmp_properties[key]
 
     def update(self, other):
+        if not other.properties:
+            return
+        if self._properties_shared:
+            self.properties = self.properties.copy()
+            self._properties_shared = False
         other_tmp_properties = other.properties.copy()
-        self._update_list(other_tmp_properties, 'cc_flags')
-        self._update_list(other_tmp_properties, 'cc_flags_after')
-        self._update_list(other_tmp_properties, 'extra_objs')
-        self._update_dict(other_tmp_properties, 'test_run_args')
-        return self.properties.update(other_tmp_properties)
+        # Most overrides set none of these, so don't even call the helpers then.
+        for key in ('cc_flags', 'cc_flags_after', 'extra_objs'):
+            if key in other_tmp_properties:
+                self._update_list(other_tmp_properties, key)
+        if 'test_run_args' in other_tmp_properties:
+            self._update_dict(other_tmp_properties, 'test_run_args')
+        self.properties.update(other_tmp_properties)
+        self._update_skip_mask()
+
+def _merge_path_properties(parent_path_properties, properties):
+    # Nodes that don't override anything, e.g. many intermediate directories,
+    # just share the PathProperties of their parent.
+    if not properties:
+        return parent_path_properties
+    merged_path_properties = PathProperties._unchecked(
+        parent_path_properties.properties,
+        parent_path_properties.skip_mask
+    )
+    # The override is only read by update, which doesn't look at its skip_mask,
+    # so don't compute one for it.
+    PathProperties._check_keys(properties)
+    merged_path_properties.update(PathProperties._unchecked(properties, 0))
+    # A single name may be given as a plain string. Without this, the `in` checks
+    # of should_be_built and should_be_tested would do substring matches on it.
+    merged_properties = merged_path_properties.properties
+    for property_key in ('allowed_archs', 'allowed_emulators'):
+        value = merged_properties[property_key]
+        if type(value) is str:
+            merged_properties[property_key] = frozenset((value,))
+        elif value is not None and not type(value) is frozenset:
+            merged_properties[property_key] = frozenset(value)
+    return merged_path_properties
 
 class PrefixTree:
-    def __init__(self, path_properties_dict=None, children=None):
+    def __init__(self, path_properties_dict=None, children=None, parent=None):
+        '''
+        :param parent: if given, path_properties are merged with those of the parent node.
+        '''
         if path_properties_dict is None:
             path_properties_dict = {}
         if children is None:
             children = {}
         self.children = children
-        self.path_properties = PathProperties(path_properties_dict)
+        if parent is None:
+            # Plain dict copy, since the root is typically given the read-only default_properties,
+            # and paths that don't override anything share the root's properties.
+            self.path_properties = PathProperties(dict(path_properties_dict))
+        else:
+            self.path_properties = _merge_path_properties(
+                parent.path_properties,
+                path_properties_dict
+            )
 
     @staticmethod
-    def make_from_tuples(tuples):
+    def make_from_tuples(tuple_, parent=None):
         '''
+        Build the tree recursively in a single pass over the tuples.
+
+        The path_properties of each node of the returned tree are already
+        merged with those of all its ancestors, so lookups don't need to merge anything.
+
         TODO check that all paths exist.
         '''
-        def tree_from_tuples(tuple_):
-            if not type(tuple_) is tuple:
-                tuple_ = (tuple_, {})
-            cur_properties, cur_children = tuple_
-            return PrefixTree(cur_properties, cur_children)
-        top_tree = tree_from_tuples(tuples)
-        todo_trees = [top_tree]
-        while todo_trees:
-            cur_tree = todo_trees.pop()
-            cur_children = cur_tree.children
-            for child_key in cur_children:
-                new_tree = tree_from_tuples(cur_children[child_key])
-                cur_children[child_key] = new_tree
-                todo_trees.append(new_tree)
-        return top_tree
+        if not type(tuple_) is tuple:
+            tuple_ = (tuple_, {})
+        cur_properties, cur_children = tuple_
+        tree = PrefixTree(cur_properties, parent=parent)
+        for child_key in cur_children:
+            tree.children[child_key] = PrefixTree.make_from_tuples(cur_children[child_key], tree)
+        return tree
 
-def get(path):
+@functools.lru_cache(maxsize=None)
+def _get_path_properties(path):
     '''
-    Get the merged path properties of a given path.
+    Merged PathProperties of a given path as stored in the tree, and the path components.
+
+    The tree is never modified after it is built, so the result only depends on path.
+    This is cached because build and test passes query the same paths over and over.
+    The components are split here so that cache hits don't even need to split the path.
+    Hit statistics can be inspected with _get_path_properties.cache_info().
     '''
+    path_components = tuple(path.split(os.sep))
     cur_node = path_properties_tree
-    path_components = path.split(os.sep)
-    path_properties = PathProperties(cur_node.path_properties.properties.copy())
     for path_component in path_components:
         if path_component in cur_node.children:
             cur_node = cur_node.children[path_component]
-            path_properties.update(cur_node.path_properties)
         else:
             break
+    return cur_node.path_properties, path_components
+
+def get(path):
+    '''
+    Get the merged path properties of a given path.
+
+    A new PathProperties is returned on each call, so callers may update it
+    without affecting the cached result.
+    '''
+    node_path_properties, path_components = _get_path_properties(path)
+    path_properties = PathProperties._unchecked(
+        node_path_properties.properties,
+        node_path_properties.skip_mask
+    )
     path_properties.set_path_components(path_components)
     return path_properties
 
@@ -503,11 +664,11 @@ path_properties_tuples = (
                                     },
                                 ),
                                 'freestanding': freestanding_properties,
-                                'lkmc_assert_eq_fail.S': {'signal_received': signal.Signals.SIGABRT},
-                                'lkmc_assert_memcmp_fail.S': {'signal_received': signal.Signals.SIGABRT},
+                                'lkmc_assert_eq_fail.S': {'signal_received': SIGABRT},
+                                'lkmc_assert_memcmp_fail.S': {'signal_received': SIGABRT},
                                 'udf.S': {
                                     'signal_generated_by_os': True,
-                                    'signal_received': signal.Signals.SIGILL,
+                                    'signal_received': SIGILL,
                                 },
                                 'vcvta.S': {
                                     'arm_aarch32': True,
@@ -548,8 +709,8 @@ path_properties_tuples = (
                                         ),
                                     }
                                 ),
-                                'lkmc_assert_eq_fail.S': {'signal_received': signal.Signals.SIGABRT},
-                                'lkmc_assert_memcmp_fail.S': {'signal_received': signal.Signals.SIGABRT},
+                                'lkmc_assert_eq_fail.S': {'signal_received': SIGABRT},
+                                'lkmc_assert_memcmp_fail.S': {'signal_received': SIGABRT},
                                 'nostartfiles': (
                                     nostartfiles_properties,
                                     {
@@ -560,7 +721,7 @@ path_properties_tuples = (
                                 ),
                                 'udf.S': {
                                     'signal_generated_by_os': True,
-                                    'signal_received': signal.Signals.SIGILL,
+                                    'signal_received': SIGILL,
                                 },
                                 'sve.S': {'arm_sve': True},
                                 'sve_addvl.S': {'arm_sve': True},
@@ -600,8 +761,8 @@ path_properties_tuples = (
                                         'exit.S': {'skip_run_unclassified': True},
                                     }
                                 ),
-                                'div_overflow.S': {'signal_received': signal.Signals.SIGFPE},
-                                'div_zero.S': {'signal_received': signal.Signals.SIGFPE},
+                                'div_overflow.S': {'signal_received': SIGFPE},
+                                'div_zero.S': {'signal_received': SIGFPE},
                                 'fabs.S': {'uses_instructions': {'x86_64': {'fcomip'}}},
                                 'fadd.S': {'uses_instructions': {'x86_64': {'fcomi'}}},
                                 'faddp.S': {'uses_instructions': {'x86_64': {'fcomip'}}},
@@ -612,17 +773,17 @@ path_properties_tuples = (
                                 'fscale.S': {'uses_instructions': {'x86_64': {'fcomip'}}},
                                 'fsqrt.S': {'uses_instructions': {'x86_64': {'fcomip', 'fsqrt'}}},
                                 'fxch.S': {'uses_instructions': {'x86_64': {'fcomip'}}},
-                                'lkmc_assert_eq_fail.S': {'signal_received': signal.Signals.SIGABRT},
-                                'lkmc_assert_memcmp_fail.S': {'signal_received': signal.Signals.SIGABRT},
+                                'lkmc_assert_eq_fail.S': {'signal_received': SIGABRT},
+                                'lkmc_assert_memcmp_fail.S': {'signal_received': SIGABRT},
                                 'popcnt.S': {'uses_instructions': {'x86_64': {'popcnt'}}},
                                 'rdrand.S': {'uses_instructions': {'x86_64': {'rdrand'}}},
                                 'rdtscp.S': {'uses_instructions': {'x86_64': {'rdtscp'}}},
-                                'ring0.c': {'signal_received': signal.Signals.SIGSEGV},
+                                'ring0.c': {'signal_received': SIGSEGV},
                                 'vfmadd132pd.S': {'uses_instructions': {'x86_64': {'vfmadd132pd'}}},
                             }
                         ),
                         'lkmc_assert_fail.S': {
-                            'signal_received': signal.Signals.SIGABRT,
+                            'signal_received': SIGABRT,
                         },
                     }
                 ),
@@ -631,12 +792,12 @@ path_properties_tuples = (
                         'baremetal': True,
                     },
                     {
-                        'abort.c': {'signal_received': signal.Signals.SIGABRT},
+                        'abort.c': {'signal_received': SIGABRT},
                         'atomic.c': {
                             'baremetal': False,
                             'test_run_args': {'cpus': 3},
                         },
-                        'assert_fail.c': {'signal_received': signal.Signals.SIGABRT},
+                        'assert_fail.c': {'signal_received': SIGABRT},
                         # This has complex failure modes, too hard to assert.
                         'smash_stack.c': {'skip_run_unclassified': True},
                         'exit1.c': {'exit_status': 1},
@@ -729,7 +890,7 @@ path_properties_tuples = (
                         'count_to.c': {'more_than_1s': True},
                         'kill.c': {
                             'baremetal': True,
-                            'signal_received': signal.Signals.SIGHUP,
+                            'signal_received': SIGHUP,
                         },
                         'fork.c': {
                             # wait